@@ -96,6 +96,20 @@ DATABASES = {
 }
 
 
+# Cache
+# 集計キャッシュ・推定ルールの版を全ワーカーで共有するため Redis を使う（REDIS_URL 未設定ならプロセス内キャッシュ）
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+
+REDIS_URL = os.getenv("REDIS_URL")
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -9,6 +9,7 @@ class CategoryAdmin(admin.ModelAdmin):
 @admin.register(Expense)
 class ExpenseAdmin(admin.ModelAdmin):
     list_display = ('id', 'date', 'item', 'amount', 'category')
+    list_select_related = ('category',)
     list_filter = ('category', 'date')
     search_fields = ('item',)
     date_hierarchy = 'date'
@@ -21,6 +22,7 @@ class HouseholdAdmin(admin.ModelAdmin):
 @admin.register(Budget)
 class BudgetAdmin(admin.ModelAdmin):
     list_display = ('month', 'category', 'amount')
+    list_select_related = ('category',)
     list_filter  = ('month', 'category')
     search_fields = ('category__name',)
     date_hierarchy = 'month'
@@ -34,6 +36,7 @@ class IncomeAdmin(admin.ModelAdmin):
 @admin.register(CategoryRule)
 class CategoryRuleAdmin(admin.ModelAdmin):
     list_display = ("keyword", "category")
+    list_select_related = ("category",)
     search_fields = ("keyword", "category__name")
 
 
@@ -1,7 +1,8 @@
 # kakeibo/forms.py
 from datetime import date
 from django import forms
-from django.forms import formset_factory
+from django.core.exceptions import NON_FIELD_ERRORS, ValidationError
+from django.forms import BaseFormSet, formset_factory
 from django.forms.widgets import ClearableFileInput
 
 from .models import Expense, Budget, Category, Income
@@ -25,11 +26,15 @@ class ExpenseFilterForm(forms.Form):
     end_date   = forms.DateField(required=False, widget=forms.DateInput(attrs={'type': 'date'}))
     q          = forms.CharField(required=False, label='キーワード')
     category   = forms.ModelChoiceField(
-        queryset=Category.objects.all().order_by('name'),
+        queryset=Category.objects.none(),  # 実際の一覧は __init__ で
         required=False,
         empty_label='（すべての費目）',
         label='費目'
     )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['category'].queryset = Category.objects.all().order_by('name')
 # ===== 支出フォーム（単票） =====
 class ExpenseForm(forms.ModelForm):
     class Meta:
@@ -79,6 +84,8 @@ class ExpenseForm(forms.ModelForm):
 class MonthInput(forms.TextInput):
     input_type = "month"
 
+BUDGET_DUPLICATE_MESSAGE = 'この「対象月×費目」の予算は既に登録済みです。'
+
 class BudgetForm(forms.ModelForm):
     month = forms.DateField(
         label='対象月',
@@ -87,13 +94,20 @@ class BudgetForm(forms.ModelForm):
     )
     category = forms.ModelChoiceField(
         label='費目（空なら全体）',
-        queryset=Category.objects.all(),
+        queryset=Category.objects.none(),  # 実際の一覧は __init__ で
         required=False,
         empty_label='— 全体 —',
     )
     class Meta:
         model = Budget
         fields = ('month', 'category', 'amount')
+        error_messages = {
+            NON_FIELD_ERRORS: {'unique_together': BUDGET_DUPLICATE_MESSAGE},
+        }
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['category'].queryset = Category.objects.all()
 
     def clean_month(self):
         m = self.cleaned_data['month']
@@ -101,15 +115,41 @@ class BudgetForm(forms.ModelForm):
 
     def clean(self):
         cleaned = super().clean()
+        # 費目ありの重複は UniqueConstraint の検証に任せる（ModelForm が実施）。
+        # NULL は制約の対象外なので「全体」予算だけここで確認する
         m = cleaned.get('month'); c = cleaned.get('category')
-        if m is not None:
+        if m is not None and c is None:
             exists = Budget.objects.exclude(pk=self.instance.pk)\
-                                   .filter(month=m, category=c).exists()
+                                   .filter(month=m, category__isnull=True).exists()
             if exists:
-                raise forms.ValidationError('この「対象月×費目」の予算は既に登録済みです。')
+                raise forms.ValidationError(BUDGET_DUPLICATE_MESSAGE)
         return cleaned
 
 # ===== レシート取込（1行=1明細） =====
+class CategoryChoiceField(forms.ModelChoiceField):
+    """共有の費目リストから選択肢を作り、選択値も DB を引かずに解決する"""
+    def set_categories(self, categories):
+        self._by_pk = {str(c.pk): c for c in categories}
+        self.choices = [("", self.empty_label)] + [
+            (c.pk, self.label_from_instance(c)) for c in categories
+        ]
+
+    def to_python(self, value):
+        by_pk = getattr(self, "_by_pk", None)
+        if by_pk is None or value in self.empty_values:
+            return super().to_python(value)
+        try:
+            return by_pk[str(value)]
+        except KeyError:
+            raise ValidationError(
+                self.error_messages["invalid_choice"],
+                code="invalid_choice",
+                params={"value": value},
+            )
+
+# 金額欄に混ざりがちな区切り・通貨記号（1回の str.translate で落とす）
+_AMOUNT_TRANS = str.maketrans('', '', ',，、. ¥￥円\t\n')
+
 class ReceiptLineForm(forms.Form):
     item = forms.CharField(
         label="項目",
@@ -119,23 +159,47 @@ class ReceiptLineForm(forms.Form):
         label="金額",
         widget=forms.NumberInput(attrs={"class": "form-control", "inputmode":"numeric"})
     )
-    category = forms.ModelChoiceField(
+    category = CategoryChoiceField(
         label="費目",
-        queryset=Category.objects.all().order_by("name"),
+        queryset=Category.objects.none(),  # 実際の一覧は __init__ で
         required=False,
         empty_label="(自動判別/未選択)",
         widget=forms.Select(attrs={"class": "form-select"})
     )
     raw_text = forms.CharField(required=False, widget=forms.HiddenInput())
 
+    def __init__(self, *args, categories=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        field = self.fields["category"]
+        field.queryset = Category.objects.all().order_by("name")
+        # formset から共有リストが来ていれば、それで選択肢を作る（行ごとに SELECT しない）
+        if categories is not None:
+            field.set_categories(categories)
+
     # カンマ等の混入を除去して整数化
     def clean_amount(self):
-        s = str(self.cleaned_data.get("amount", "")).replace(",", "").replace("，","")
+        s = str(self.cleaned_data.get("amount", "")).translate(_AMOUNT_TRANS)
+        if s.isdecimal():
+            return int(s)
+        # 想定外の文字が残ったときだけ数字を拾い直す
         s = "".join(ch for ch in s if ch.isdigit())
         return int(s) if s else 0
 
+class BaseReceiptLineFormSet(BaseFormSet):
+    """費目一覧を1回だけ取得して全行で共有する（行ごとの SELECT を避ける）"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.categories = list(Category.objects.all().order_by("name"))
+
+    def get_form_kwargs(self, index):
+        kwargs = super().get_form_kwargs(index)
+        kwargs["categories"] = self.categories
+        return kwargs
+
 # 行削除を有効化
-ReceiptLineFormSet = formset_factory(ReceiptLineForm, extra=0, can_delete=True)
+ReceiptLineFormSet = formset_factory(
+    ReceiptLineForm, formset=BaseReceiptLineFormSet, extra=0, can_delete=True
+)
 
 # アップロードフォーム
 class ReceiptUploadForm(forms.Form):
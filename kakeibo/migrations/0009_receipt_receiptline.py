@@ -0,0 +1,42 @@
+# Generated by Django 5.2.7 on 2026-10-14 19:25
+
+import datetime
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kakeibo', '0008_categoryrule'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Receipt',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('image', models.ImageField(upload_to='receipts/%Y/%m/%d')),
+                ('store', models.CharField(blank=True, max_length=120)),
+                ('date', models.DateField(default=datetime.date.today)),
+                ('total', models.IntegerField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('pending', '待機中'), ('processing', '解析中'), ('done', '完了'), ('error', 'エラー')], default='pending', max_length=10)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ReceiptLine',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('raw_text', models.CharField(max_length=255)),
+                ('item', models.CharField(blank=True, max_length=255)),
+                ('amount', models.IntegerField(blank=True, null=True)),
+                ('include', models.BooleanField(default=True)),
+                ('confidence', models.FloatField(blank=True, null=True)),
+                ('y_min', models.IntegerField(blank=True, null=True)),
+                ('y_max', models.IntegerField(blank=True, null=True)),
+                ('category', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='kakeibo.category')),
+                ('receipt', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lines', to='kakeibo.receipt')),
+            ],
+        ),
+    ]
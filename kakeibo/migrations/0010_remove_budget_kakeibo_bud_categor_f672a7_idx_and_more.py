@@ -0,0 +1,22 @@
+# Generated by Django 5.2.7 on 2026-10-14 19:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kakeibo', '0009_receipt_receiptline'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='budget',
+            name='kakeibo_bud_categor_f672a7_idx',
+        ),
+        migrations.AlterField(
+            model_name='budget',
+            name='month',
+            field=models.DateField(verbose_name='対象月（1日固定）'),
+        ),
+    ]
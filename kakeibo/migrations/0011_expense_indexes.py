@@ -0,0 +1,21 @@
+# Generated by Django 5.2.7 on 2026-10-14 19:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kakeibo', '0010_remove_budget_kakeibo_bud_categor_f672a7_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='expense',
+            index=models.Index(fields=['-date', '-id'], name='kakeibo_exp_date_0d5657_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='expense',
+            index=models.Index(fields=['category', 'date'], name='kakeibo_exp_categor_d0c894_idx'),
+        ),
+    ]
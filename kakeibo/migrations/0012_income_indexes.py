@@ -0,0 +1,17 @@
+# Generated by Django 5.2.7 on 2026-10-15 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kakeibo', '0011_expense_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='income',
+            index=models.Index(fields=['-date'], name='kakeibo_inc_date_2871e6_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-15 11:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kakeibo', '0012_income_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='receipt',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
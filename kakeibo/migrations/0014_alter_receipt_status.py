@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-15 11:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kakeibo', '0013_receipt_claimed_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='receipt',
+            name='status',
+            field=models.CharField(choices=[('pending', '待機中'), ('processing', '解析中'), ('done', '完了'), ('error', 'エラー'), ('registered', '登録済み')], default='pending', max_length=10),
+        ),
+    ]
@@ -36,13 +36,17 @@ class Expense(models.Model):
 
     class Meta:
         ordering = ['-date']
+        indexes = [
+            models.Index(fields=['-date', '-id']),       # 一覧の並び（日付降順）
+            models.Index(fields=['category', 'date']),   # 費目別×月範囲の集計
+        ]
 
     def __str__(self) -> str:
         return f"{self.date} {self.item} {self.amount}円"
 
 
 class Budget(models.Model):
-    month   = models.DateField('対象月（1日固定）', db_index=True)
+    month   = models.DateField('対象月（1日固定）')
     category = models.ForeignKey(
         Category, null=True, blank=True,
         on_delete=models.SET_NULL,
@@ -59,9 +63,9 @@ class Budget(models.Model):
                 name='uniq_budget_month_category'
             )
         ]
+        # category は FK の自動インデックスがあるので month だけ
         indexes = [
             models.Index(fields=['month']),
-            models.Index(fields=['category']),
         ]
 
     def save(self, *args, **kwargs):
@@ -83,6 +87,9 @@ class Income(models.Model):
 
     class Meta:
         ordering = ['-date']
+        indexes = [
+            models.Index(fields=['-date']),   # 一覧の並び＋月範囲の集計
+        ]
 
     def __str__(self):
         return f'{self.date} {self.source} {self.amount}円'
@@ -96,10 +103,26 @@ class CategoryRule(models.Model):
 
 # 画像アップしてOCR → 行ごとに確認してからExpenseへ落とす用
 class Receipt(models.Model):
+    # OCR はバックグラウンドで実行（tasks.py）→ レビュー画面は status を見て待つ
+    STATUS_PENDING = 'pending'
+    STATUS_PROCESSING = 'processing'
+    STATUS_DONE = 'done'
+    STATUS_ERROR = 'error'
+    STATUS_REGISTERED = 'registered'   # レビューから支出に登録済み（再登録させない）
+    STATUS_CHOICES = [
+        (STATUS_PENDING, '待機中'),
+        (STATUS_PROCESSING, '解析中'),
+        (STATUS_DONE, '完了'),
+        (STATUS_ERROR, 'エラー'),
+        (STATUS_REGISTERED, '登録済み'),
+    ]
+
     image = models.ImageField(upload_to='receipts/%Y/%m/%d')
     store = models.CharField(max_length=120, blank=True)
     date = models.DateField(default=date.today)
     total = models.IntegerField(null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    claimed_at = models.DateTimeField(null=True, blank=True)  # ワーカーが processing にした時刻
     created_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
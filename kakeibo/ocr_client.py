@@ -1,33 +1,59 @@
 from __future__ import annotations
 
-import re
+import logging
+from functools import lru_cache
+from io import BytesIO
 from pathlib import Path
 from typing import List, Dict, Optional, Union, IO
 
+import ahocorasick
 import numpy as np
 import cv2
+from PIL import Image as PILImage
+# OCR の1行ごとに走るパターンは RE2（線形時間・バックトラック無し）で評価する
+import re2 as re
 
 from django.conf import settings
 from django.core.files.uploadedfile import UploadedFile
 from google.cloud import vision
 from google.oauth2 import service_account
 
-from .utils import guess_category
+from .utils import guess_category_batch
 
+logger = logging.getLogger(__name__)
 
 # ====== ノイズ除外用パターン ======
-TEL_RE    = re.compile(r'(TEL|電話|CALL)[:：]?\s*\d{2,4}[-‐–―ー]?\d{2,4}[-‐–―ー]?\d{3,4}')
-POINT_RE  = re.compile(r'(ﾎﾟｲﾝﾄ|ポイント|T-?POINT|楽天ポイント|dポイント|P[ ：]?\d+)')
+# RE2 の \d / \s は ASCII のみなので、全角数字・全角スペースも拾うよう明示する
+_DIGIT = '[0-9０-９]'
+_SPACE = r'[\s　]'
+TEL_RE    = re.compile(rf'(TEL|電話|CALL)[:：]?{_SPACE}*{_DIGIT}{{2,4}}[-‐–―ー]?{_DIGIT}{{2,4}}[-‐–―ー]?{_DIGIT}{{3,4}}')
+POINT_RE  = re.compile(rf'(ﾎﾟｲﾝﾄ|ポイント|T-?POINT|楽天ポイント|dポイント|P[ ：]?{_DIGIT}+)')
 IGNORE_HARD = (
     'お買上', '領収', 'ありがとうございました', '軽減税率', '小計対象',
     'レジ', '担当', '合計点数', '小計', '合計', '税込', '税抜', '内税', '外税',
     '割引', '値引', 'クーポン', '会員', 'No.', '№'
 )
-MONEY_RE = re.compile(r'([0-9]{1,3}(?:[,，][0-9]{3})+|[0-9]+)\s*(円)?$')
-MEMBER_RE = re.compile(r'(会員|会員番号|ﾒﾝﾊﾞｰ|ID)[:：]?\s*[A-Z0-9\-]{6,}')
+# 行は strip 済みで渡す。RE2 の $ は（複数行モードでなければ）文字列末尾 = \z
+MONEY_RE = re.compile(rf'([0-9]{{1,3}}(?:[,，][0-9]{{3}})+|[0-9]+){_SPACE}*(円)?$')
+MEMBER_RE = re.compile(rf'(会員|会員番号|ﾒﾝﾊﾞｰ|ID)[:：]?{_SPACE}*[A-Z0-9\-]{{6,}}')
 CARD_RE   = re.compile(r'(VISA|MASTER|JCB|AMEX|WAON|nanaco|Suica|PASMO|PayPay|楽天Edy)')
+MASK_RE   = re.compile(r'[＊*#]{4,}')
+# 行ごとの判定を1回の走査で済ませるため、ノイズ系はまとめて1本にする
+NOISE_RE  = re.compile('|'.join(
+    f'(?:{rx.pattern})' for rx in (TEL_RE, POINT_RE, MEMBER_RE, CARD_RE, MASK_RE)
+))
+# IGNORE_HARD は固定文字列なので Aho-Corasick で全語を1パス照合
+_IGNORE_HARD_AC = ahocorasick.Automaton()
+for _k in IGNORE_HARD:
+    _IGNORE_HARD_AC.add_word(_k, _k)
+_IGNORE_HARD_AC.make_automaton()
+
+def _has_ignore_word(text: str) -> bool:
+    return next(_IGNORE_HARD_AC.iter(text), None) is not None
 
 # ====== Vision クライアント（settingsのJSONを最優先で利用） ======
+# 認証情報の読込と gRPC チャネル確立は重いので、プロセスで1つを使い回す
+@lru_cache(maxsize=1)
 def _gcv_client() -> vision.ImageAnnotatorClient:
     cred_file: Path = getattr(settings, 'VISION_CREDENTIALS_FILE', None)
     if isinstance(cred_file, (str, Path)):
@@ -40,6 +66,9 @@ def _gcv_client() -> vision.ImageAnnotatorClient:
 
 
 # ====== 画像前処理（OpenCV） ======
+# これ未満の画素数なら前処理しない（スクショ等の小さくきれいな画像）
+SMALL_IMAGE_PIXELS = 1_000_000
+
 def _to_bytes(image: Union[bytes, bytearray, memoryview, str, Path, UploadedFile, IO[bytes]]) -> bytes:
     # すでに bytes 系
     if isinstance(image, (bytes, bytearray, memoryview)):
@@ -69,33 +98,76 @@ def _to_bytes(image: Union[bytes, bytearray, memoryview, str, Path, UploadedFile
     p = Path(image)
     return p.read_bytes()
 
+def _image_path(image) -> Optional[str]:
+    """ディスク上にある画像ならそのパス（パス指定 / TemporaryUploadedFile）"""
+    if isinstance(image, (str, Path)):
+        return str(image)
+    if hasattr(image, "temporary_file_path"):
+        return image.temporary_file_path()
+    return None
+
+def _decode(image, path: Optional[str], raw: Optional[bytes]):
+    """画像 → (元の bytes or None, BGR ndarray or None)"""
+    if path is not None:
+        # ファイルは OpenCV に直接読ませる（Python 側に画像サイズのバッファを作らない）
+        img = cv2.imread(path, cv2.IMREAD_COLOR)
+        if img is not None:
+            return None, img
+    if raw is None:
+        raw = _to_bytes(image)
+    return raw, cv2.imdecode(np.frombuffer(raw, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+def _pixel_count(src) -> Optional[int]:
+    """ヘッダだけ読んで画素数を返す（デコードしない）。読めなければ None"""
+    try:
+        with PILImage.open(src) as im:
+            w, h = im.size
+    except Exception:
+        return None
+    return w * h
+
 def _preprocess(image) -> bytes:
-    """画像 → ほどよく前処理したPNG bytes（OCR精度向上用）"""
-    raw = _to_bytes(image)
+    """画像 → ほどよく前処理したJPEG bytes（OCR精度向上用）"""
+    path = _image_path(image)
+    raw = None if path is not None else _to_bytes(image)
+
+    # 小さい画像は前処理の効果が薄いので、OpenCV を通さずそのまま送る
+    pixels = _pixel_count(path if path is not None else BytesIO(raw))
+    if pixels is not None and pixels < SMALL_IMAGE_PIXELS:
+        return raw if raw is not None else _to_bytes(image)
 
-    arr = np.frombuffer(raw, dtype=np.uint8)
-    img = cv2.imdecode(arr, cv2.IMREAD_COLOR)
+    raw, img = _decode(image, path, raw)
     if img is None:
         return raw  # もし開けなければそのまま
 
+    # 先に2000px程度へ長辺リサイズ（過剰解像の抑制＆以降のフィルタを軽くする）
+    h, w = img.shape[:2]
+    max_side = max(h, w)
+    if max_side > 2000:
+        scale = 2000 / max_side
+        img = cv2.resize(img, (int(w*scale), int(h*scale)), interpolation=cv2.INTER_AREA)
+
     # グレースケール化＆軽いノイズ除去→二値化
     gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    gray = cv2.bilateralFilter(gray, 7, 50, 50)
+    gray = cv2.GaussianBlur(gray, (3, 3), 0)
     thr  = cv2.adaptiveThreshold(gray, 255,
                                  cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
                                  cv2.THRESH_BINARY, 31, 7)
 
-    # 2000px程度に長辺リサイズ（過剰解像の抑制）
-    h, w = thr.shape[:2]
-    max_side = max(h, w)
-    if max_side > 2000:
-        scale = 2000 / max_side
-        thr = cv2.resize(thr, (int(w*scale), int(h*scale)), interpolation=cv2.INTER_AREA)
-
-    ok, buf = cv2.imencode(".png", thr)
-    return bytes(buf) if ok else raw
+    # PNG より大幅に小さく、Vision への送信量を抑えられる
+    ok, buf = cv2.imencode(".jpg", thr, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    if ok:
+        return buf.tobytes()
+    return raw if raw is not None else _to_bytes(image)
 
 # ====== メイン：行抽出 ======
+_IMAGE_CONTEXT = vision.ImageContext(language_hints=['ja', 'en'])
+# batch_annotate_images の1リクエストあたりの上限
+BATCH_MAX_IMAGES = 16
+# 1回の RPC の待ち時間の上限（秒）。tasks.OCR_STALE_SECONDS より十分短くして、
+# 生きているバッチが「止まった」とみなされて別の worker に取られないようにする
+RPC_TIMEOUT = getattr(settings, "OCR_RPC_TIMEOUT", 120)
+
 def extract_lines(image: Union[bytes, str, Path]) -> List[Dict]:
     """
     入力画像から「1行=1明細」を推定して返す。
@@ -105,61 +177,82 @@ def extract_lines(image: Union[bytes, str, Path]) -> List[Dict]:
     client = _gcv_client()
 
     img = vision.Image(content=content)
-    resp = client.document_text_detection(
-        image=img, image_context=vision.ImageContext(language_hints=['ja', 'en'])
-    )
+    resp = client.document_text_detection(image=img, image_context=_IMAGE_CONTEXT)
     if resp.error.message:
         raise RuntimeError(resp.error.message)
+    return _lines_from_response(resp)
+
+def extract_lines_batch(images: list) -> List[Optional[List[Dict]]]:
+    """
+    複数画像をまとめて OCR（BATCH_MAX_IMAGES 枚ごとに1回の RPC）。
+    戻り値は images と同じ順の extract_lines 相当のリスト。失敗した画像は None。
+    """
+    client = _gcv_client()
+    feature = vision.Feature(type_=vision.Feature.Type.DOCUMENT_TEXT_DETECTION)
+    results: List[Optional[List[Dict]]] = []
+    for i in range(0, len(images), BATCH_MAX_IMAGES):
+        # 読めない画像はその枠だけ None にして、残りの画像だけを送る
+        contents = [_preprocess_or_none(image) for image in images[i:i + BATCH_MAX_IMAGES]]
+        requests = [
+            vision.AnnotateImageRequest(
+                image=vision.Image(content=content),
+                features=[feature],
+                image_context=_IMAGE_CONTEXT,
+            )
+            for content in contents if content is not None
+        ]
+        responses = iter(client.batch_annotate_images(requests=requests, timeout=RPC_TIMEOUT).responses
+                         if requests else ())
+        for content in contents:
+            if content is None:
+                results.append(None)
+                continue
+            resp = next(responses)
+            results.append(None if resp.error.message else _lines_from_response(resp))
+    return results
+
+def _preprocess_or_none(image) -> Optional[bytes]:
+    try:
+        return _preprocess(image)
+    except Exception:
+        logger.exception("Preprocessing failed: image=%r", image)
+        return None
 
+def _lines_from_response(resp) -> List[Dict]:
     out: List[Dict] = []
     if not resp.text_annotations:
         return out
 
     # token単位のバウンディングから y で行グループ化
-    tokens = []
-    for a in resp.text_annotations[1:]:
-        y = min(v.y for v in a.bounding_poly.vertices)
-        tokens.append((y, a.description))
-    tokens.sort(key=lambda t: t[0])
-
-    groups: List[list] = []
-    buf: List[tuple] = []
-    cur_y: Optional[float] = None
-    for y, tok in tokens:
-        if cur_y is None or abs(y - cur_y) <= 15:
-            buf.append((y, tok))
-            cur_y = y if cur_y is None else (0.8 * cur_y + 0.2 * y)
-        else:
-            groups.append(buf)
-            buf = [(y, tok)]
-            cur_y = y
-    if buf:
-        groups.append(buf)
+    # （y でソートし、隣との差が 15px を超えるところで行を切る）
+    anns = resp.text_annotations[1:]
+    ys = np.fromiter((min(v.y for v in a.bounding_poly.vertices) for a in anns),
+                     dtype=np.int32, count=len(anns))
+    descs = [a.description for a in anns]
+    order = np.argsort(ys, kind='stable')
+    cuts = np.where(np.diff(ys[order]) > 15)[0] + 1
+    groups = np.split(order, cuts) if len(order) else []
 
     for g in groups:
-        text = " ".join(tok for _, tok in g)
+        text = " ".join(descs[i] for i in g)
         text = text.replace('¥', '').replace(',', ' ').strip()
         raw = text
 
-        # 明確なノイズはここで捨てる
-        if TEL_RE.search(text) or POINT_RE.search(text):
-            continue
-        if any(k in text for k in IGNORE_HARD):
-            continue
-        # 任意で会員/カード系も弾きたい場合は追加
-        if MEMBER_RE.search(text) or CARD_RE.search(text) or re.search(r'[＊*#]{4,}', text):
+        # 明確なノイズ（電話/ポイント/会員/カード/伏字・集計行）はここで捨てる
+        if NOISE_RE.search(text) or _has_ignore_word(text):
             continue
 
         m = MONEY_RE.search(text)
         if not m:
             continue
         amount = int(m.group(1).replace(',', '').replace('，', ''))
-        name = MONEY_RE.sub('', text).strip(" :：-–—~〜\t")
+        name = text[:m.start()].strip(" :：-–—~〜\t")
         if not name:
             continue
 
-        y_min = min(y for y, _ in g)
-        y_max = max(y for y, _ in g)
+        # g は y の昇順に並んだ添字なので端が最小/最大
+        y_min = int(ys[g[0]])
+        y_max = int(ys[g[-1]])
 
         out.append({
             "raw_text": raw,
@@ -174,11 +267,9 @@ def extract_lines(image: Union[bytes, str, Path]) -> List[Dict]:
 def parse_receipt(image_file) -> List[Dict]:
     """UploadedFile など -> [{'item', 'amount', 'category'}...] を返す"""
     rows = extract_lines(image_file)  # 新実装を呼ぶ
-    results: List[Dict] = []
-    for r in rows:
-        cat = guess_category(item=r["item"])
-        results.append({"item": r["item"], "amount": r["amount"], "category": cat})
-    return results
+    cats = guess_category_batch([r["item"] for r in rows])
+    return [{"item": r["item"], "amount": r["amount"], "category": cat}
+            for r, cat in zip(rows, cats)]
 
 def upload_receipt(request):
     if request.method == "POST":
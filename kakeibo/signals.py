@@ -0,0 +1,34 @@
+# kakeibo/signals.py
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Budget, Category, CategoryRule, Expense, Income
+from .utils import clear_aggregate_cache, clear_rule_cache, load_ai_settings
+
+
+# ルール/費目が変わったら推定用キャッシュを作り直す
+@receiver([post_save, post_delete], sender=CategoryRule)
+@receiver([post_save, post_delete], sender=Category)
+def _reset_rule_cache(sender, **kwargs):
+    clear_rule_cache()
+
+
+# 支出/収入/予算（と費目名）が変わったら集計キャッシュを捨てる
+# コミット前に捨てると、並行リクエストが古いデータで新しい版のキャッシュを作ってしまうのでコミット後に捨てる
+# （bulk_create はシグナルが出ないので呼び出し側で捨てる）
+@receiver([post_save, post_delete], sender=Category)
+@receiver([post_save, post_delete], sender=Budget)
+@receiver([post_save, post_delete], sender=Income)
+@receiver([post_save, post_delete], sender=Expense)
+def _reset_aggregate_cache(sender, **kwargs):
+    transaction.on_commit(clear_aggregate_cache)
+
+
+# 判定結果はクラウド設定にも依存するので、設定が差し替わったら捨てる（テストの override_settings など）
+@receiver(setting_changed)
+def _reset_on_setting_changed(setting, **kwargs):
+    if setting == "CATEGORY_AI":
+        load_ai_settings()
+        clear_rule_cache()
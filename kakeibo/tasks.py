@@ -0,0 +1,193 @@
+# kakeibo/tasks.py
+# レシート OCR をリクエストスレッドの外で実行する（プロセス内ワーカー）
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import cv2
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Receipt, ReceiptLine
+from .ocr_client import BATCH_MAX_IMAGES, extract_lines_batch
+from .utils import guess_category_batch
+
+logger = logging.getLogger(__name__)
+
+# ワーカー側でスレッドを並べるので OpenCV 内部の並列化は切る
+cv2.setNumThreads(1)
+
+_EXECUTOR = ThreadPoolExecutor(
+    max_workers=getattr(settings, "OCR_WORKERS", 2),
+    thread_name_prefix="ocr",
+)
+
+# processing のままこれ以上経った Receipt は、確保したワーカーが止まったとみなして待機中に戻す
+OCR_STALE_SECONDS = getattr(settings, "OCR_STALE_SECONDS", 600)
+# pending のままこれ以上経った Receipt は、投入したプロセスが止まったとみなしてワーカーを起こし直す
+OCR_PENDING_GRACE_SECONDS = getattr(settings, "OCR_PENDING_GRACE_SECONDS", 30)
+OCR_RESUME_INTERVAL = getattr(settings, "OCR_RESUME_INTERVAL", 30)
+_RESUME_GUARD_KEY = "kakeibo:ocr:resume"
+
+# === ノイズ行フィルタ ===
+_SKIP_PATTERNS = [
+    r'小計', r'合計', r'計[ 　]*小', r'消費税', r'内税', r'外税',
+    r'領収', r'お会計', r'会計', r'担当', r'レジ', r'番号', r'No\.?',
+    r'有効期限', r'TEL|電話', r'ﾎﾟｲﾝﾄ|ポイント|T-?POINT|dポイント|楽天ポイント',
+    r'^\s*[A-Z]{1,2}\s*$',          # 単独の英字
+    r'^\s*\d{6,}\s*$',              # 桁の多い連番（電話/カード末尾 等）
+]
+_SKIP_RE = re.compile("|".join(f"(?:{p})" for p in _SKIP_PATTERNS))
+
+def _drop_noise(item: str, amount: int) -> bool:
+    s = item.strip() if item else ""
+    if len(s) < 2:
+        return True
+    # 電話番号などが金額に入ったケースを除外（閾値は適宜調整）
+    if amount is not None and amount > 300000:
+        return True
+    # 数字だけの行は正規表現を通さず決める（6桁以上の連番だけがノイズ）
+    if s.isdecimal():
+        return len(s) >= 6
+    return _SKIP_RE.search(item) is not None
+
+
+def ocr_pending_receipts(limit: int = None) -> None:
+    """
+    待機中の Receipt を最大 limit 件まとめて確保し、1回の batch RPC で OCR して
+    ReceiptLine を作る。完了/失敗は各 Receipt の status に残す。
+    """
+    limit = limit or getattr(settings, "OCR_BATCH_SIZE", BATCH_MAX_IMAGES)
+    close_old_connections()
+    try:
+        requeue_stale_receipts()
+        pending = (Receipt.objects.filter(status=Receipt.STATUS_PENDING)
+                                  .order_by("id")
+                                  .values_list("id", flat=True)[:limit])
+        # 他のワーカーと取り合わないよう1件ずつ確保する
+        claimed = [pk for pk in pending
+                   if Receipt.objects.filter(pk=pk, status=Receipt.STATUS_PENDING)
+                                     .update(status=Receipt.STATUS_PROCESSING,
+                                             claimed_at=timezone.now())]
+        if not claimed:
+            return
+        receipts = list(Receipt.objects.filter(pk__in=claimed).order_by("id"))
+
+        try:
+            images = [_image_source(receipt) for receipt in receipts]
+            results = extract_lines_batch(images)  # [[{'item','amount',...}], ...]
+        except Exception:
+            logger.exception("OCR failed: receipts=%s", claimed)
+            for receipt in receipts:
+                _mark_error(receipt)
+            return
+        finally:
+            for receipt in receipts:
+                receipt.image.close()
+
+        for receipt, raw_rows in zip(receipts, results):
+            if raw_rows is None:
+                logger.error("OCR failed: receipt=%s", receipt.pk)
+                _mark_error(receipt)
+                continue
+            # 1件の保存/分類の失敗で processing のまま残さない（他の Receipt は続ける）
+            try:
+                _save_lines(receipt, raw_rows)
+            except Exception:
+                logger.exception("Saving OCR lines failed: receipt=%s", receipt.pk)
+                _mark_error(receipt)
+    finally:
+        close_old_connections()
+
+
+def requeue_stale_receipts() -> int:
+    """確保したまま止まった（ワーカーのプロセス再起動など）Receipt を待機中に戻す。戻した件数を返す"""
+    cutoff = timezone.now() - timedelta(seconds=OCR_STALE_SECONDS)
+    return (Receipt.objects.filter(Q(claimed_at__lt=cutoff) | Q(claimed_at__isnull=True),
+                                   status=Receipt.STATUS_PROCESSING)
+                           .update(status=Receipt.STATUS_PENDING, claimed_at=None))
+
+
+def resume_if_stalled(receipt: Receipt) -> None:
+    """ポーリング中の Receipt が進んでいなければワーカーを起こし直す（再起動で投入/確保が失われた場合）"""
+    now = timezone.now()
+    if receipt.status == Receipt.STATUS_PENDING:
+        stalled = receipt.created_at < now - timedelta(seconds=OCR_PENDING_GRACE_SECONDS)
+    elif receipt.status == Receipt.STATUS_PROCESSING:
+        stalled = (receipt.claimed_at is None
+                   or receipt.claimed_at < now - timedelta(seconds=OCR_STALE_SECONDS))
+    else:
+        stalled = False
+    # ポーリングは1秒ごとに来るので、起こし直しは OCR_RESUME_INTERVAL 秒に1回まで
+    if stalled and cache.add(_RESUME_GUARD_KEY, 1, OCR_RESUME_INTERVAL):
+        enqueue_ocr()
+
+
+def _still_claimed(receipt: Receipt):
+    """この worker が確保したままの Receipt（待機中に戻されて別の worker が取っていれば空）"""
+    return Receipt.objects.filter(pk=receipt.pk, status=Receipt.STATUS_PROCESSING,
+                                  claimed_at=receipt.claimed_at)
+
+
+def _mark_error(receipt: Receipt) -> None:
+    _still_claimed(receipt).update(status=Receipt.STATUS_ERROR)
+
+
+def _image_source(receipt: Receipt):
+    """
+    ローカル保存ならパスを渡して OCR 側で直接デコードさせる。
+    それ以外はファイルのまま渡し、前処理の直前に1枚ずつ読ませる（バッチ全枚の bytes を同時に持たない）
+    """
+    try:
+        return receipt.image.path
+    except NotImplementedError:
+        return receipt.image
+
+
+def _save_lines(receipt: Receipt, raw_rows) -> None:
+    lines = []
+    for r in raw_rows:
+        item = (r.get("item") or "").strip()
+        amt  = int(r.get("amount") or 0)
+        if _drop_noise(item, amt):
+            continue
+        lines.append(ReceiptLine(
+            receipt=receipt,
+            raw_text=(r.get("raw_text") or "")[:255],
+            item=item,
+            amount=amt,
+            confidence=r.get("confidence"),
+            y_min=r.get("y_min"),
+            y_max=r.get("y_max"),
+        ))
+    # 費目はレシート単位でまとめて推定する
+    for line, cat in zip(lines, guess_category_batch([line.item for line in lines])):
+        line.category = cat
+
+    # 確保したままのときだけ結果を書く（遅れて終わった worker が行を重複させたり、登録済みを戻したりしない）
+    with transaction.atomic():
+        if _still_claimed(receipt).update(status=Receipt.STATUS_DONE):
+            ReceiptLine.objects.bulk_create(lines)
+        else:
+            logger.warning("Discarding OCR result of a receipt no longer claimed: receipt=%s", receipt.pk)
+
+
+def enqueue_ocr() -> None:
+    """
+    コミット後にワーカーへ投入（未コミットの Receipt を別スレッドから読まないように）。
+    ワーカーはその時点で待機中の Receipt をまとめて処理する。
+    """
+    transaction.on_commit(
+        lambda: _EXECUTOR.submit(ocr_pending_receipts).add_done_callback(_log_worker_error)
+    )
+
+
+def _log_worker_error(future) -> None:
+    # submit した Future は誰も result() を見ないので、ここで落ちた例外を記録する
+    exc = future.exception()
+    if exc is not None:
+        logger.error("OCR worker crashed", exc_info=exc)
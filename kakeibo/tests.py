@@ -1,3 +1,119 @@
+from datetime import date, timedelta
+from unittest import mock
+
 from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import Expense, Receipt, ReceiptLine
+from .tasks import OCR_STALE_SECONDS, _save_lines, ocr_pending_receipts, requeue_stale_receipts
+
+OCR_ROWS = [{"item": "牛乳", "amount": 198, "raw_text": "牛乳 198"}]
+
+
+# ワーカーはテストの DB 接続を閉じないようにし、Vision は呼ばない
+@mock.patch("kakeibo.tasks.close_old_connections")
+@mock.patch("kakeibo.tasks.extract_lines_batch")
+class OcrWorkerTests(TestCase):
+    def make_receipt(self, **kwargs):
+        return Receipt.objects.create(image="receipts/test.jpg", date=date(2026, 10, 1), **kwargs)
+
+    def test_claims_pending_receipt_and_saves_lines(self, extract, _close):
+        receipt = self.make_receipt()
+        extract.return_value = [OCR_ROWS]
+
+        ocr_pending_receipts()
+
+        receipt.refresh_from_db()
+        self.assertEqual(receipt.status, Receipt.STATUS_DONE)
+        self.assertIsNotNone(receipt.claimed_at)
+        self.assertEqual(list(receipt.lines.values_list("item", "amount")), [("牛乳", 198)])
+
+    def test_does_not_claim_receipt_held_by_another_worker(self, extract, _close):
+        receipt = self.make_receipt(status=Receipt.STATUS_PROCESSING, claimed_at=timezone.now())
+
+        ocr_pending_receipts()
+
+        extract.assert_not_called()
+        receipt.refresh_from_db()
+        self.assertEqual(receipt.status, Receipt.STATUS_PROCESSING)
+
+    def test_failed_image_marks_only_that_receipt(self, extract, _close):
+        ok, bad = self.make_receipt(), self.make_receipt()
+        extract.return_value = [OCR_ROWS, None]
+
+        ocr_pending_receipts()
+
+        ok.refresh_from_db()
+        bad.refresh_from_db()
+        self.assertEqual(ok.status, Receipt.STATUS_DONE)
+        self.assertEqual(bad.status, Receipt.STATUS_ERROR)
+
+    def test_stale_processing_receipt_is_requeued(self, extract, _close):
+        old = timezone.now() - timedelta(seconds=OCR_STALE_SECONDS + 1)
+        stale = self.make_receipt(status=Receipt.STATUS_PROCESSING, claimed_at=old)
+        live = self.make_receipt(status=Receipt.STATUS_PROCESSING, claimed_at=timezone.now())
+
+        self.assertEqual(requeue_stale_receipts(), 1)
+
+        stale.refresh_from_db()
+        live.refresh_from_db()
+        self.assertEqual(stale.status, Receipt.STATUS_PENDING)
+        self.assertIsNone(stale.claimed_at)
+        self.assertEqual(live.status, Receipt.STATUS_PROCESSING)
+
+    def test_late_worker_does_not_overwrite_result(self, extract, _close):
+        # 待機中に戻され、別の worker が処理して登録まで済んだ後に古い worker が終わったケース
+        old = timezone.now() - timedelta(seconds=OCR_STALE_SECONDS + 1)
+        late = self.make_receipt(status=Receipt.STATUS_PROCESSING, claimed_at=old)
+        Receipt.objects.filter(pk=late.pk).update(status=Receipt.STATUS_REGISTERED,
+                                                  claimed_at=timezone.now())
+
+        _save_lines(late, OCR_ROWS)
+
+        late.refresh_from_db()
+        self.assertEqual(late.status, Receipt.STATUS_REGISTERED)
+        self.assertFalse(ReceiptLine.objects.filter(receipt=late).exists())
+
+
+class ReceiptReviewTests(TestCase):
+    def setUp(self):
+        self.receipt = Receipt.objects.create(
+            image="receipts/test.jpg", date=date(2026, 10, 1), status=Receipt.STATUS_DONE,
+        )
+        ReceiptLine.objects.create(receipt=self.receipt, raw_text="牛乳 198", item="牛乳", amount=198)
+        self.url = reverse("kakeibo:receipt_review", kwargs={"pk": self.receipt.pk})
+        self.data = {
+            "form-TOTAL_FORMS": "1",
+            "form-INITIAL_FORMS": "1",
+            "form-0-item": "牛乳",
+            "form-0-amount": "198",
+            "form-0-category": "",
+            "form-0-raw_text": "牛乳 198",
+        }
+
+    def test_registers_once(self):
+        self.client.post(self.url, self.data)
+        self.receipt.refresh_from_db()
+        self.assertEqual(self.receipt.status, Receipt.STATUS_REGISTERED)
+        self.assertEqual(Expense.objects.count(), 1)
+
+        # 戻る→再送信しても二重登録しない
+        resp = self.client.post(self.url, self.data)
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(Expense.objects.count(), 1)
+
+    def test_registered_receipt_is_not_reviewed_again(self):
+        Receipt.objects.filter(pk=self.receipt.pk).update(status=Receipt.STATUS_REGISTERED)
+        resp = self.client.get(self.url)
+        self.assertRedirects(resp, f"{reverse('kakeibo:expense_list')}?month=2026-10&view=all",
+                             fetch_redirect_response=False)
+
 
-# Create your tests here.
+class GuessCategoryApiTests(TestCase):
+    def test_bad_category_ids_are_guessed_instead(self):
+        items = [{"item": "a", "category": "²"}, {"item": "b", "category": "9" * 30}]
+        resp = self.client.post(reverse("kakeibo:guess_category_api"),
+                                {"items": items}, content_type="application/json")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json()["results"], [{"id": None, "name": None}] * 2)
@@ -36,10 +36,12 @@ urlpatterns = [
 
     # OCR フロー
     path("receipt/upload/", views.ReceiptUploadView.as_view(), name="receipt_upload"),
-    path("receipt/review/", views.ReceiptReviewView.as_view(), name="receipt_review"),
+    path("receipt/<int:pk>/processing/", views.ReceiptProcessingView.as_view(), name="receipt_processing"),
+    path("receipt/<int:pk>/review/", views.ReceiptReviewView.as_view(), name="receipt_review"),
 
     # API
     path("api/guess-category/", views.guess_category_api, name="guess_category_api"),
+    path("api/receipt/<int:pk>/status/", views.receipt_status_api, name="receipt_status_api"),
 
     #まとめ削除機能
     path('expenses/bulk-delete/', views.ExpenseBulkDeleteView.as_view(), name='expense_bulk_delete'),
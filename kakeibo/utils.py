@@ -1,8 +1,15 @@
 # kakeibo/utils.py
+import time
 import unicodedata
-from typing import Optional, Tuple
+from functools import lru_cache
+from typing import Callable, Iterable, List, Optional, Tuple, Union
+from uuid import uuid4
+
+import ahocorasick
 from django.conf import settings
-from django.db.models.functions import Length
+from django.core.cache import cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
 from .models import Category
 
 try:
@@ -25,12 +32,122 @@ FALLBACK_KEYWORDS = {
 def _norm(s: str) -> str:
     if not s:
         return ""
+    if s.isascii():  # ASCII は NFKC で変わらない
+        return s.lower()
     return unicodedata.normalize("NFKC", s).lower()
 
-def _get_category_by_name(name: str) -> Optional[Category]:
+# 内蔵辞書は正規化済みの形で持っておく（インデックス再構築のたびに正規化しない）
+_FALLBACK_NORM = {cat: [_norm(w) for w in words] for cat, words in FALLBACK_KEYWORDS.items()}
+
+def _get_category_by_name(name: str, index: dict) -> Optional[Category]:
     if not name:
         return None
-    return Category.objects.filter(name=name).first()
+    return index["by_name"].get(name)
+
+def _load_categories_by_name() -> dict:
+    """{費目名: Category}。同名があれば並び順で先のものを使う"""
+    by_name: dict = {}
+    for c in Category.objects.all():
+        by_name.setdefault(c.name, c)
+    return by_name
+
+# 推定用インデックス（プロセス内キャッシュ）
+#   automaton  : DBルール＋内蔵辞書の Aho-Corasick（正規化キーワード -> 優先キー, category_id）
+#   categories : {category_id: Category}（キーワードの行き先）
+#   by_name    : {費目名: Category}（クラウドの結果を引く用）
+# CategoryRule / Category の保存・削除シグナルで破棄する（signals.py）。
+# 他プロセスの変更は django.core.cache のバージョン値で検知し、
+# 共有キャッシュが無い構成でも RULE_CACHE_TTL 秒で作り直す。
+RULE_CACHE_TTL = 60
+_RULES_VERSION_KEY = "kakeibo:category_rules:version"
+_RULE_CACHE: dict = {"index": None, "version": None, "built_at": 0.0}
+
+def clear_rule_cache() -> None:
+    _RULE_CACHE["index"] = None
+    _classify_text.cache_clear()
+    cache.set(_RULES_VERSION_KEY, uuid4().hex, None)
+
+def _rule_index() -> dict:
+    version = cache.get_or_set(_RULES_VERSION_KEY, lambda: uuid4().hex, None)
+    index = _RULE_CACHE["index"]
+    if (index is not None
+            and _RULE_CACHE["version"] == version
+            and time.monotonic() - _RULE_CACHE["built_at"] < RULE_CACHE_TTL):
+        return index
+
+    by_name = _load_categories_by_name()
+    categories: dict = {}
+    index = {
+        "automaton": _build_automaton(categories, by_name),
+        "categories": categories,
+        "by_name": by_name,
+    }
+    _RULE_CACHE.update(index=index, version=version, built_at=time.monotonic())
+    _classify_text.cache_clear()  # 古いルールでの判定結果は捨てる
+    return index
+
+# 集計結果のキャッシュ（ダッシュボード・分析 API）
+# 支出/収入/予算が変わったら版を差し替え、古い版のキーは参照されないまま期限切れになる。
+# 版の差し替えを全ワーカーで共有できないプロセス内キャッシュ（LocMem/Dummy）では使わない。
+AGGREGATE_CACHE_TTL = 300
+_AGGREGATES_VERSION_KEY = "kakeibo:aggregates:version"
+
+def _cache_is_shared() -> bool:
+    return not isinstance(caches["default"], (LocMemCache, DummyCache))
+
+def cached_aggregate(key: str, build: Callable[[], dict]) -> dict:
+    """key の集計結果を共有キャッシュから返す（無ければ build() して入れる）"""
+    if not _cache_is_shared():
+        return build()
+    version = cache.get_or_set(_AGGREGATES_VERSION_KEY, lambda: uuid4().hex, None)
+    return cache.get_or_set(f"kakeibo:{key}:{version}", build, AGGREGATE_CACHE_TTL)
+
+def clear_aggregate_cache() -> None:
+    if _cache_is_shared():
+        cache.set(_AGGREGATES_VERSION_KEY, uuid4().hex, None)
+
+def _build_automaton(categories: dict, by_name: dict):
+    """
+    DBルールと内蔵辞書を1つのオートマトンにまとめる（categories も埋める）。
+    優先キーは小さいほど優先:
+      (0, -len, keyword)       DBルール … 長いキーワード優先、同じ長さならキーワード順
+      (1, 費目の順, 語の順)     内蔵辞書 … FALLBACK_KEYWORDS の並び順（DBに無い費目は除く）
+    """
+    entries = []
+    if CategoryRule is not None:
+        for r in CategoryRule.objects.select_related("category"):
+            entries.append((_norm(r.keyword), (0, -len(r.keyword), r.keyword), r.category))
+    for ci, (cat_name, words) in enumerate(_FALLBACK_NORM.items()):
+        cat = by_name.get(cat_name)
+        if cat is None:
+            continue
+        for wi, w in enumerate(words):
+            entries.append((w, (1, ci, wi), cat))
+
+    auto = ahocorasick.Automaton()
+    for kw, key, cat in entries:
+        if not kw:
+            continue
+        if kw in auto and auto.get(kw)[0] <= key:
+            continue
+        auto.add_word(kw, (key, cat.pk))
+        categories[cat.pk] = cat
+
+    if not len(auto):
+        return None
+    auto.make_automaton()
+    return auto
+
+# クラウド推定の設定（呼び出しごとに settings を引かない。差し替え時は signals.py から読み直す）
+_AI_CFG: dict = {}
+_AI_THRESHOLD = 0.65
+
+def load_ai_settings() -> None:
+    global _AI_CFG, _AI_THRESHOLD
+    _AI_CFG = getattr(settings, "CATEGORY_AI", {"enabled": False})
+    _AI_THRESHOLD = float(_AI_CFG.get("threshold", 0.65))
+
+load_ai_settings()
 
 def _cloud_classify(text: str) -> Optional[Tuple[str, float]]:
     """
@@ -38,21 +155,66 @@ def _cloud_classify(text: str) -> Optional[Tuple[str, float]]:
     ここではダミー実装。実際のAPI呼び出しは後で差し込む。
     戻り値例: ("食費", 0.83)  /  見つからなければ None
     """
-    cfg = getattr(settings, "CATEGORY_AI", {"enabled": False})
-    if not cfg.get("enabled"):
+    if not _AI_CFG.get("enabled"):
         return None
 
     # --- ここに実際のクラウド呼び出しを入れる（例） ---
     # OpenAI/Bedrock/Vertex/Comprehend などでテキスト分類 or LLMプロンプト
     # resp_label, resp_score = call_provider(text)  # 0.0 - 1.0
     # ラベルをアプリのカテゴリ名に写像
-    # label_map = cfg.get("label_map", {})
+    # label_map = _AI_CFG.get("label_map", {})
     # mapped = label_map.get(resp_label, resp_label)
     # return mapped, float(resp_score)
     # -----------------------------------------------
 
     return None  # まだ未実装なので None
 
+def _cloud_classify_batch(texts: List[str]) -> List[Optional[Tuple[str, float]]]:
+    """
+    複数行を1リクエストにまとめてクラウドに投げ、texts と同じ順で (label, score) / None を返す想定。
+    ここではダミー実装（1プロンプトに番号付きで並べ、番号順のラベル配列を受け取る形を想定）。
+    """
+    if not _AI_CFG.get("enabled") or not texts:
+        return [None] * len(texts)
+
+    # --- ここに実際のクラウド呼び出しを入れる（例） ---
+    # prompt = "\n".join(f"{i}: {t}" for i, t in enumerate(texts))
+    # labels = call_provider_batch(prompt)  # [(label, score) | None, ...]
+    # label_map = _AI_CFG.get("label_map", {})
+    # return [(label_map.get(l, l), float(sc)) if l else None for l, sc in labels]
+    # -----------------------------------------------
+
+    return [None] * len(texts)  # まだ未実装なので None
+
+def _accept_cloud(label_score: Optional[Tuple[str, float]], index: dict) -> Optional[Category]:
+    """クラウドの結果が threshold 以上なら費目に解決する"""
+    if label_score:
+        label, score = label_score
+        if score >= _AI_THRESHOLD:
+            return _get_category_by_name(label, index)
+    return None
+
+def _match_rules(text: str, index: dict) -> Optional[Category]:
+    """
+    DBルール → 内蔵辞書（1回の走査で全キーワードを照合し、優先キー最小を採用）。
+    index は呼び出し側で1回だけ _rule_index() したもの（行ごとにルールの版を問い合わせない）
+    """
+    auto = index["automaton"]
+    if auto is not None:
+        best = min((payload for _, payload in auto.iter(text)), default=None)
+        if best:
+            return index["categories"][best[1]]
+    return None
+
+@lru_cache(maxsize=512)
+def _classify_text(text: str) -> Optional[Category]:
+    """
+    正規化済みテキスト -> 費目。ルール索引を作り直すたびに破棄する。
+    呼び出し直前に guess_category が版を確かめた索引を使う（ここではキャッシュを読まない）
+    """
+    index = _RULE_CACHE["index"] or _rule_index()
+    return _match_rules(text, index) or _accept_cloud(_cloud_classify(text), index)
+
 def guess_category(item: str, memo: str = "", user_choice: Optional[Category] = None) -> Optional[Category]:
     """
     優先順位:
@@ -60,36 +222,31 @@ def guess_category(item: str, memo: str = "", user_choice: Optional[Category] =
       2) DBルール（最長一致）
       3) 内蔵辞書
       4) クラウド（有効時＆score>=threshold）
+    費目名の解決はキャッシュ済みの一覧を使う
     """
     if user_choice:
         return user_choice
 
     text = _norm((item or "") + " " + (memo or ""))
+    _rule_index()  # ルールの版が変わっていればここで作り直し、判定キャッシュも捨てる
+    return _classify_text(text)
 
-    # 2) DBルール：長いキーワード優先
-    if CategoryRule is not None:
-        rules = (CategoryRule.objects
-                 .select_related("category")
-                 .annotate(klen=Length("keyword"))
-                 .order_by("-klen", "keyword"))
-        for r in rules:
-            if _norm(r.keyword) in text:
-                return r.category
-
-    # 3) 内蔵辞書
-    for cat_name, words in FALLBACK_KEYWORDS.items():
-        for w in words:
-            if _norm(w) in text:
-                found = _get_category_by_name(cat_name)
-                if found:
-                    return found
-
-    # 4) クラウド
-    label_score = _cloud_classify(text)
-    if label_score:
-        label, score = label_score
-        threshold = float(getattr(settings, "CATEGORY_AI", {}).get("threshold", 0.65))
-        if score >= threshold:
-            return _get_category_by_name(label)
+def guess_category_batch(items: Iterable[Union[str, Tuple[str, str]]]) -> List[Optional[Category]]:
+    """
+    レシートの複数行をまとめて分類する（items は item か (item, memo)。結果は同じ順）。
+    ルール/内蔵辞書で決まらなかった行だけを1回のクラウド呼び出しにまとめる。
+    """
+    texts = []
+    for it in items:
+        item, memo = (it, "") if isinstance(it, str) else it
+        texts.append(_norm((item or "") + " " + (memo or "")))
+    # 同じ品名が何行も出るので、判定は重複を除いたテキストごとに1回（ルールの版の確認はレシートで1回）
+    index = _rule_index()
+    resolved = {t: _match_rules(t, index) for t in dict.fromkeys(texts)}
 
-    return None
+    pending = [t for t, cat in resolved.items() if cat is None]
+    if pending:
+        answers = _cloud_classify_batch(pending)
+        for t, label_score in zip(pending, answers):
+            resolved[t] = _accept_cloud(label_score, index)
+    return [resolved[t] for t in texts]
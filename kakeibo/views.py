@@ -1,8 +1,9 @@
 # kakeibo/views.py
+import json
+import re
+from collections import namedtuple
 from datetime import date
-from uuid import uuid4
 import calendar as _cal
-import re
 
 from django.http import JsonResponse
 from django.urls import reverse, reverse_lazy, NoReverseMatch
@@ -10,36 +11,64 @@ from django.views import View
 from django.views.generic import (
     ListView, CreateView, UpdateView, DeleteView, TemplateView, FormView
 )
-from django.db.models import Sum, Count
-from django.db.models.functions import TruncMonth
-from django.shortcuts import redirect
+from django.db import IntegrityError, transaction
+from django.db.models import Sum, Count, Case, When, F, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, ExtractDay, TruncMonth
+from django.shortcuts import get_object_or_404, redirect
 from django.contrib import messages
-from django.core.files.storage import default_storage
-from django.core.files.base import ContentFile
 from django.views.decorators.http import require_POST
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_protect
 
-from .models import Expense, Budget, Income, Category
+from .models import Expense, Budget, Income, Category, Receipt
 from .forms import (
     ExpenseForm, ExpenseFilterForm, BudgetForm, IncomeForm,
-    ReceiptUploadForm, ReceiptLineFormSet
+    ReceiptUploadForm, ReceiptLineFormSet, BUDGET_DUPLICATE_MESSAGE
+)
+from .utils import (
+    guess_category, guess_category_batch, cached_aggregate, clear_aggregate_cache
 )
-from .utils import guess_category
-from .ocr_client import extract_lines
+from .tasks import enqueue_ocr, resume_if_stalled
 
 
 # ===== 共通ヘルパー =====
+# 一覧表示で使う列だけ読む（費目は名前だけあればよい）
+_EXPENSE_LIST_FIELDS = ('id', 'date', 'item', 'amount', 'category_id', 'category__name')
+# ?sort= の値 -> order_by の並び（費目順は同じ費目内を日付・id で揃える）
+_EXPENSE_SORTS = {
+    'date':      ('date', '-id'),
+    '-date':     ('-date', '-id'),
+    'amount':    ('amount', '-id'),
+    '-amount':   ('-amount', '-id'),
+    'item':      ('item', '-id'),
+    '-item':     ('-item', '-id'),
+    'category':  ('category__name', 'date', 'id'),
+    '-category': ('-category__name', '-date', '-id'),
+}
+
+# ?month= の書式（年は 1000-9999、月は 1-12。範囲外はここで弾くので date() は失敗しない）
+_MONTH_RE = re.compile(r'([1-9]\d{3})-(0?[1-9]|1[0-2])')
+
+
 def _parse_month_param(request):
-    """?month=YYYY-MM -> date(YYYY, MM, 1)。無ければ当月1日"""
+    """?month=YYYY-MM -> date(YYYY, MM, 1)。無ければ当月1日（結果は request に保持）"""
+    if hasattr(request, '_cur_month'):
+        return request._cur_month
     m = request.GET.get('month')
-    if m:
-        try:
-            y, mm = map(int, m.split('-'))
-            return date(y, mm, 1)
-        except ValueError:
-            pass
-    return date.today().replace(day=1)
+    mo = _MONTH_RE.fullmatch(m) if m else None
+    cur = date(int(mo[1]), int(mo[2]), 1) if mo else date.today().replace(day=1)
+    request._cur_month = cur
+    return cur
+
+
+def _base_qs(request) -> str:
+    """ページ/月リンク用に page と month を除いたクエリ文字列（結果は request に保持）"""
+    if not hasattr(request, '_base_qs'):
+        q = request.GET.copy()
+        q.pop('page', None)
+        q.pop('month', None)
+        request._base_qs = q.urlencode()
+    return request._base_qs
 
 
 def month_bounds(y: int, m: int):
@@ -56,9 +85,41 @@ def add_month(d: date, k: int) -> date:
     return date(y, m, 1)
 
 
+def _recent_months(cur: date, n: int = 6) -> list:
+    """cur を含む直近 n か月の月初（古→新）"""
+    return [add_month(cur, k) for k in range(1 - n, 1)]
+
+
+def _monthly_totals(model, start: date, end: date) -> dict:
+    """[start, end) の amount 合計を月初日ごとに1クエリで集計 -> {date(月初): 合計}"""
+    rows = (model.objects.filter(date__gte=start, date__lt=end)
+                 .annotate(m=TruncMonth('date'))
+                 .values('m')
+                 .order_by()
+                 .annotate(total=Sum('amount')))
+    return {r['m']: (r['total'] or 0) for r in rows}
+
+
+def _daily_totals(qs, kind: str):
+    """qs の amount を日（1..31）ごとに合計 -> (day, kind, total) の values_list（union 用）"""
+    return (qs.annotate(day=ExtractDay('date'), kind=Value(kind))
+              .values('day', 'kind')
+              .order_by()
+              .annotate(total=Sum('amount'))
+              .values_list('day', 'kind', 'total'))
+
+
+# カレンダーの1日分（exp=支出合計 赤表示想定 / inc=収入合計 緑表示想定 / has=どちらかあり）
+CalendarCell = namedtuple('CalendarCell', 'date exp inc has')
+
+
 # ===== カテゴリ推定 API =====
 @require_POST
 def guess_category_api(request):
+    # JSON で {"items": [{item, memo, category}, ...]} を送ればまとめて判定する
+    if request.content_type == 'application/json':
+        return _guess_category_many(request)
+
     item = request.POST.get('item', '')
     memo = request.POST.get('memo', '')
     cat_id = request.POST.get('category')  # 既に選択済みなら尊重
@@ -76,6 +137,39 @@ def guess_category_api(request):
     return JsonResponse({"ok": True, "suggested_id": cat.id, "suggested_name": cat.name})
 
 
+def _parse_pk(value):
+    """pk として使える正の整数（DB の整数に収まるもの）。それ以外は None（=推定に回す）"""
+    try:
+        pk = int(str(value or ''))
+    except ValueError:
+        return None
+    return pk if 0 < pk < 2 ** 63 else None
+
+
+def _guess_category_many(request):
+    """複数行の推定を1リクエストで返す -> {"ok", "results": [{"id", "name"}, ...]}（items と同じ順）"""
+    try:
+        items = json.loads(request.body).get('items')
+    except (ValueError, AttributeError):
+        items = None
+    if not isinstance(items, list) or not all(isinstance(it, dict) for it in items):
+        return JsonResponse({"ok": False, "error": "items must be a list of objects"}, status=400)
+
+    # 選択済みの費目は1クエリでまとめて引き、それ以外だけ推定する
+    ids = [_parse_pk(it.get('category')) for it in items]
+    chosen = Category.objects.in_bulk({pk for pk in ids if pk is not None})
+    cats = [chosen.get(pk) if pk is not None else None for pk in ids]
+    pending = [i for i, cat in enumerate(cats) if cat is None]
+    guessed = guess_category_batch(
+        [(str(items[i].get('item') or ''), str(items[i].get('memo') or '')) for i in pending]
+    )
+    for i, cat in zip(pending, guessed):
+        cats[i] = cat
+
+    results = [{"id": c.id, "name": c.name} if c else {"id": None, "name": None} for c in cats]
+    return JsonResponse({"ok": True, "results": results}, json_dumps_params={"ensure_ascii": False})
+
+
 # ===== ダッシュボード =====
 class DashboardView(TemplateView):
     template_name = 'kakeibo/dashboard.html'
@@ -83,27 +177,32 @@ class DashboardView(TemplateView):
     def get_context_data(self, **kwargs):
         ctx = super().get_context_data(**kwargs)
 
-        # 月の決定
+        # 月の決定。集計は月ごとにキャッシュ（支出/収入/予算が変わると版が変わって作り直し）
         cur = _parse_month_param(self.request)
+        ctx.update(cached_aggregate(f'dashboard:{cur:%Y-%m}', lambda: self.build(cur)))
+        return ctx
+
+    def build(self, cur):
+        ctx = {}
         start, end = month_bounds(cur.year, cur.month)
         ctx['current_month'] = cur
         ctx['prev_month']    = add_month(cur, -1)
         ctx['next_month']    = add_month(cur, +1)
 
+        # 直近6か月の月別合計（支出/収入 各1クエリ。今月分もここから取る）
+        months = _recent_months(cur)
+        exp_by_month = _monthly_totals(Expense, months[0], end)
+        inc_by_month = _monthly_totals(Income, months[0], end)
+
         # 今月の集計（支出/収入/収支）
         qs_exp = Expense.objects.filter(date__gte=start, date__lt=end)
         qs_inc = Income.objects.filter(date__gte=start, date__lt=end)
-        exp_total = qs_exp.aggregate(total=Sum('amount'))['total'] or 0
-        inc_total = qs_inc.aggregate(total=Sum('amount'))['total'] or 0
+        exp_total = exp_by_month.get(start, 0)
+        inc_total = inc_by_month.get(start, 0)
         ctx['expense_total'] = exp_total
         ctx['income_total']  = inc_total
         ctx['net_total']     = inc_total - exp_total
 
-        # 予算（全体）
-        overall = Budget.objects.filter(month=start, category__isnull=True)\
-                                .aggregate(total=Sum('amount'))['total']
-        ctx['overall_budget'] = overall
-
         # 円グラフ：カテゴリ内訳（今月）
         by_cat = (qs_exp.values('category__name')
                         .annotate(total=Sum('amount'))
@@ -112,70 +211,65 @@ class DashboardView(TemplateView):
         ctx['pie_values'] = [r['total'] or 0 for r in by_cat]
 
         # 折れ線：直近6か月（支出/収入）
-        labels, last6_exp, last6_inc = [], [], []
-        for k in range(5, -1, -1):  # 古→新
-            d = add_month(cur, -k)
-            s, e = month_bounds(d.year, d.month)
-            labels.append(f'{d.year}-{d.month:02d}')
-            last6_exp.append(Expense.objects.filter(date__gte=s, date__lt=e)
-                             .aggregate(total=Sum('amount'))['total'] or 0)
-            last6_inc.append(Income.objects.filter(date__gte=s, date__lt=e)
-                             .aggregate(total=Sum('amount'))['total'] or 0)
-        ctx['last6_labels'] = labels
-        ctx['last6_exp']    = last6_exp
-        ctx['last6_inc']    = last6_inc
+        ctx['last6_labels'] = [f'{d.year}-{d.month:02d}' for d in months]
+        ctx['last6_exp']    = [exp_by_month.get(d, 0) for d in months]
+        ctx['last6_inc']    = [inc_by_month.get(d, 0) for d in months]
 
         # 予算進捗（カテゴリ）
-        budgets = { (b.category_id or 0): b.amount
-                    for b in Budget.objects.filter(month=start) }
-        spent_by_cat = { (r['category_id'] or 0): (r['total'] or 0)
-                         for r in qs_exp.values('category_id')
-                                        .annotate(total=Sum('amount')) }
+        # 予算行に今月の支出をサブクエリで載せる（全体予算=カテゴリ無しは未分類の支出と突き合わせる）
+        spent_subq = (Expense.objects
+                      .filter(date__gte=start, date__lt=end, category_id=OuterRef('category_id'))
+                      .values('category_id').annotate(s=Sum('amount')).values('s'))
+        uncat_subq = (qs_exp.filter(category__isnull=True)
+                      .values('category_id').annotate(s=Sum('amount')).values('s'))
+        spent_expr = Coalesce(
+            Case(When(category__isnull=True, then=Subquery(uncat_subq)),
+                 default=Subquery(spent_subq)),
+            0,
+        )
+        budget_rows = list(Budget.objects.filter(month=start)
+                                 .annotate(spent=spent_expr, remain=F('amount') - spent_expr)
+                                 .values('category_id', 'category__name', 'amount', 'spent', 'remain'))
         rows = []
-        for key, spent in spent_by_cat.items():
-            name = (Expense.objects
-                    .filter(category_id=(None if key==0 else key))
-                    .values_list('category__name', flat=True).first()) or '未分類'
-            rows.append({
-                'name': name,
-                'spent': spent,
-                'budget': budgets.get(key),
-                'remain': (budgets.get(key) - spent) if budgets.get(key) else None,
-            })
-        # 予算があるのに支出がまだのカテゴリも出す
-        for key, amount in budgets.items():
-            if key not in spent_by_cat:
-                name = Budget.objects.filter(month=start, category_id=(None if key==0 else key))\
-                                     .values_list('category__name', flat=True).first() or '全体'
-                rows.append({'name': name, 'spent': 0, 'budget': amount, 'remain': amount})
+        for r in budget_rows:
+            if r['category_id']:
+                name = r['category__name']
+            else:
+                name = '未分類' if r['spent'] else '全体'
+            rows.append({'name': name, 'spent': r['spent'], 'budget': r['amount'], 'remain': r['remain']})
+        # 予算（全体）＝カテゴリ無しの予算行の合計（無ければ None）
+        overall = [r['amount'] for r in budget_rows if not r['category_id']]
+        ctx['overall_budget'] = sum(overall) if overall else None
+        # 予算の無いカテゴリの支出も出す
+        unbudgeted = qs_exp.exclude(category_id__in=[r['category_id'] for r in budget_rows if r['category_id']])
+        if any(not r['category_id'] for r in budget_rows):
+            unbudgeted = unbudgeted.exclude(category__isnull=True)
+        for r in unbudgeted.values('category_id', 'category__name').annotate(total=Sum('amount')):
+            rows.append({'name': r['category__name'] or '未分類', 'spent': r['total'] or 0,
+                         'budget': None, 'remain': None})
         ctx['cat_progress'] = sorted(rows, key=lambda r: (r['budget'] is None, r['name']))
 
         # 今月の支出一覧（最新10件）
-        ctx['recent_expenses'] = (qs_exp.select_related('category')
-                                  .order_by('-date', '-id')[:10])
+        ctx['recent_expenses'] = list(qs_exp.select_related('category')
+                                       .only(*_EXPENSE_LIST_FIELDS)
+                                       .order_by('-date', '-id')[:10])
 
         # カレンダー用データ（支出＋収入）
         first_wd, days_in_month = _cal.monthrange(cur.year, cur.month)
-        exp_map = dict(
-            qs_exp.values('date').annotate(total=Sum('amount')).values_list('date', 'total')
-        )
-        inc_map = dict(
-            qs_inc.values('date').annotate(total=Sum('amount')).values_list('date', 'total')
-        )
+        # 日（1..31 の整数）ごとの合計。月内なので日付そのものをキーにしなくてよい
+        # 支出と収入は UNION ALL で1クエリにまとめ、種別の列で振り分ける
+        day_maps = {'e': {}, 'i': {}}
+        for day, kind, total in _daily_totals(qs_exp, 'e').union(_daily_totals(qs_inc, 'i'), all=True):
+            day_maps[kind][day] = total
+        exp_map, inc_map = day_maps['e'], day_maps['i']
 
         rows = []
         week = [None] * first_wd
         for day in range(1, days_in_month + 1):
-            d = date(cur.year, cur.month, day)
-            exp = int(exp_map.get(d, 0) or 0)
-            inc = int(inc_map.get(d, 0) or 0)
-            cell = {
-                'date': d,
-                'exp': exp,   # 支出合計（赤表示想定）
-                'inc': inc,   # 収入合計（緑表示想定）
-                'has': bool(exp or inc),
-            }
-            week.append(cell)
+            d = date(cur.year, cur.month, day)   # テンプレートで data-day/日表示に使う
+            exp = int(exp_map.get(day) or 0)
+            inc = int(inc_map.get(day) or 0)
+            week.append(CalendarCell(d, exp, inc, bool(exp or inc)))
             if len(week) == 7:
                 rows.append(week)
                 week = []
@@ -200,11 +294,7 @@ class AnalyticsPageView(TemplateView):
         ctx['prev_month']    = add_month(cur, -1)
         ctx['next_month']    = add_month(cur, +1)
         ctx['today']         = date.today()
-
-        qs = self.request.GET.copy()
-        qs.pop('page', None)
-        qs.pop('month', None)
-        ctx['base_qs'] = qs.urlencode()
+        ctx['base_qs']       = _base_qs(self.request)
         return ctx
 
 
@@ -212,10 +302,20 @@ class AnalyticsApiView(View):
     """GET /api/analytics/?month=YYYY-MM -> ダッシュボード用 JSON"""
     def get(self, request):
         cur = _parse_month_param(request)
+        # 月ごとにキャッシュ（支出が変わると版が変わって作り直し）
+        data = cached_aggregate(f"analytics:{cur:%Y-%m}", lambda: self.build(cur))
+        return JsonResponse(data, json_dumps_params={"ensure_ascii": False})
+
+    def build(self, cur):
         start, end = month_bounds(cur.year, cur.month)
 
+        # 直近6か月の月別合計（今月・先月もここから取る）
+        months = _recent_months(cur)
+        by_month = _monthly_totals(Expense, months[0], end)
+        prev = months[-2]
+
         qs_month = Expense.objects.filter(date__gte=start, date__lt=end)
-        total = qs_month.aggregate(total=Sum("amount"))["total"] or 0
+        total = by_month.get(start, 0)
 
         rows = (qs_month.values("category__name")
                         .annotate(total=Sum("amount"))
@@ -225,17 +325,9 @@ class AnalyticsApiView(View):
             for r in rows
         ]
 
-        last_6m = []
-        for k in range(5, -1, -1):
-            d = add_month(cur, -k)
-            s, e = month_bounds(d.year, d.month)
-            t = Expense.objects.filter(date__gte=s, date__lt=e)\
-                               .aggregate(total=Sum("amount"))["total"] or 0
-            last_6m.append({"month": s.strftime("%Y-%m"), "total": t})
-
-        ps, pe = month_bounds(add_month(cur, -1).year, add_month(cur, -1).month)
-        prev_total = Expense.objects.filter(date__gte=ps, date__lt=pe)\
-                                    .aggregate(total=Sum("amount"))["total"] or 0
+        last_6m = [{"month": f"{d.year}-{d.month:02d}", "total": by_month.get(d, 0)} for d in months]
+
+        prev_total = by_month.get(prev, 0)
         mom_pct = ((total - prev_total) / prev_total) if prev_total else None
 
         ys, ye = month_bounds(cur.year - 1, cur.month)
@@ -268,7 +360,7 @@ class AnalyticsApiView(View):
             "budget": {"overall": overall_budget} if overall_budget is not None else None,
             "cloud_suggestions": suggestions,
         }
-        return JsonResponse(data, json_dumps_params={"ensure_ascii": False})
+        return data
 
 
 # ===== 収入 =====
@@ -330,7 +422,7 @@ class ExpenseListView(ListView):
         return self.paginate_by
     
     def get_queryset(self):
-        qs = super().get_queryset().select_related('category')
+        qs = super().get_queryset().select_related('category').only(*_EXPENSE_LIST_FIELDS)
 
         # ---- フィルタフォーム適用 ----
         f = ExpenseFilterForm(self.request.GET or None)
@@ -360,14 +452,7 @@ class ExpenseListView(ListView):
 
         # ---- 並び替え（任意）----
         sort = self.request.GET.get('sort')
-        if sort in ('date', '-date', 'amount', '-amount', 'item', '-item', 'category', '-category'):
-            if 'category' in sort:
-                prefix = '-' if sort.startswith('-') else ''
-                qs = qs.order_by(f'{prefix}category__name', f'{prefix}date', f'{prefix}id')
-            else:
-                qs = qs.order_by(sort, '-id')
-        else:
-            qs = qs.order_by('-date', '-id')
+        qs = qs.order_by(*_EXPENSE_SORTS.get(sort, ('-date', '-id')))
 
         return qs
 
@@ -375,7 +460,7 @@ class ExpenseListView(ListView):
 
     def get_context_data(self, **kwargs):
         ctx = super().get_context_data(**kwargs)
-        cur = getattr(self, 'current_month', _parse_month_param(self.request))
+        cur = _parse_month_param(self.request)  # request に保持済みの値
 
         ctx['filter_form']   = getattr(self, 'filter_form', ExpenseFilterForm())
         ctx['current_month'] = cur
@@ -383,10 +468,8 @@ class ExpenseListView(ListView):
         ctx['next_month']    = add_month(cur, 1)
         ctx['this_month']    = date.today().replace(day=1)
 
-        # ページングリンク用クエリを保持（page は除去）
-        qs = self.request.GET.copy()
-        qs.pop('page', None)
-        ctx['base_qs'] = qs.urlencode()
+        # ページングリンク用クエリを保持（page と month はリンク側で付け直す）
+        ctx['base_qs'] = _base_qs(self.request)
 
         # 画面側で「全件表示中」などを出せるように
         ctx['is_all'] = (self.request.GET.get('view') == 'all')
@@ -464,10 +547,7 @@ class ExpenseMonthlySummaryView(ListView):
         ctx['current_month'] = cur
         ctx['prev_month']    = add_month(cur, -1)
         ctx['next_month']    = add_month(cur, +1)
-        qs = self.request.GET.copy()
-        qs.pop('page', None)
-        qs.pop('month', None)
-        ctx['base_qs'] = qs.urlencode()
+        ctx['base_qs']       = _base_qs(self.request)
         return ctx
 
 @method_decorator(csrf_protect, name='dispatch')
@@ -497,7 +577,7 @@ class BudgetListView(ListView):
 
     def get_context_data(self, **kwargs):
         ctx = super().get_context_data(**kwargs)
-        cur = getattr(self, 'current_month', _parse_month_param(self.request))
+        cur = _parse_month_param(self.request)  # request に保持済みの値
         ctx['current_month'] = cur
         ctx['prev_month']    = add_month(cur, -1)
         ctx['next_month']    = add_month(cur, +1)
@@ -505,7 +585,18 @@ class BudgetListView(ListView):
         return ctx
 
 
-class BudgetCreateView(CreateView):
+class BudgetSaveMixin:
+    """検証後に同時登録された重複は DB の UniqueConstraint で弾き、フォームエラーにする"""
+    def form_valid(self, form):
+        try:
+            with transaction.atomic():
+                return super().form_valid(form)
+        except IntegrityError:
+            form.add_error(None, BUDGET_DUPLICATE_MESSAGE)
+            return self.form_invalid(form)
+
+
+class BudgetCreateView(BudgetSaveMixin, CreateView):
     model = Budget
     form_class = BudgetForm
     template_name = 'kakeibo/budget_form.html'
@@ -523,7 +614,7 @@ class BudgetCreateView(CreateView):
         return f"{reverse('kakeibo:budget_list')}?month={m}"
 
 
-class BudgetUpdateView(UpdateView):
+class BudgetUpdateView(BudgetSaveMixin, UpdateView):
     model = Budget
     form_class = BudgetForm
     template_name = 'kakeibo/budget_form.html'
@@ -551,91 +642,90 @@ class BudgetDeleteView(DeleteView):
         m = getattr(self, '_redir_month', date.today().strftime('%Y-%m'))
         return f"{reverse('kakeibo:budget_list')}?month={m}"
 
-# === ノイズ行フィルタ ===
-_SKIP_PATTERNS = [
-    r'小計', r'合計', r'計[ 　]*小', r'消費税', r'内税', r'外税',
-    r'領収', r'お会計', r'会計', r'担当', r'レジ', r'番号', r'No\.?',
-    r'有効期限', r'TEL|電話', r'ﾎﾟｲﾝﾄ|ポイント|T-?POINT|dポイント|楽天ポイント',
-    r'^\s*[A-Z]{1,2}\s*$',          # 単独の英字
-    r'^\s*\d{6,}\s*$',              # 桁の多い連番（電話/カード末尾 等）
-]
-_SKIP_RE = [re.compile(p) for p in _SKIP_PATTERNS]
-
-def _drop_noise(item: str, amount: int) -> bool:
-    if not item or len(item.strip()) < 2:
-        return True
-    for rx in _SKIP_RE:
-        if rx.search(item):
-            return True
-    # 電話番号などが金額に入ったケースを除外（閾値は適宜調整）
-    if amount is not None and amount > 300000:
-        return True
-    return False
-
-
 # ===== レシート取り込み：アップロード → レビュー =====
 class ReceiptUploadView(FormView):
     template_name = "kakeibo/receipt_upload.html"
     form_class = ReceiptUploadForm
 
     def form_valid(self, form):
-        from .ocr_client import extract_lines   # 循環回避のためローカル import
-        d   = form.cleaned_data["date"]
-        f   = form.cleaned_data["image"]
-        f.seek(0)
-        data = f.read()
-
-        # プレビュー用に保存（開発）
-        tmp_path = default_storage.save(f"receipts/tmp/{uuid4().hex}.jpg", ContentFile(data))
-        self.request.session["ocr_image_url"] = default_storage.url(tmp_path)
-        self.request.session["ocr_date"] = d.isoformat()
-
-        # OCR
-        raw_rows = extract_lines(data)  # [{'item','amount',...}]
-        initial = []
-        for r in raw_rows:
-            item = (r.get("item") or "").strip()
-            amt  = int(r.get("amount") or 0)
-            if _drop_noise(item, amt):
-                continue
-            cat = guess_category(item=item)
-            initial.append({
-                "item": item,
-                "amount": amt,
-                "category": (cat.pk if cat else None),
-                "raw_text": r.get("raw_text",""),
-            })
+        # 画像を保存して OCR はワーカーへ（リクエストはすぐ返す）
+        receipt = Receipt.objects.create(
+            date=form.cleaned_data["date"],
+            image=form.cleaned_data["image"],
+        )
+        enqueue_ocr()
+        return redirect("kakeibo:receipt_processing", pk=receipt.pk)
+
 
-        # セッションへ預けて確認画面へ
-        self.request.session["ocr_initial"] = initial
-        return redirect("kakeibo:receipt_review")
+class ReceiptProcessingView(TemplateView):
+    """OCR 完了待ち。JS で receipt_status_api をポーリングしてレビューへ進む"""
+    template_name = "kakeibo/receipt_processing.html"
+
+    def get(self, request, *args, **kwargs):
+        self.receipt = get_object_or_404(Receipt, pk=kwargs["pk"])
+        if self.receipt.status in (Receipt.STATUS_DONE, Receipt.STATUS_REGISTERED):
+            return redirect("kakeibo:receipt_review", pk=self.receipt.pk)
+        return super().get(request, *args, **kwargs)
+
+    def get_context_data(self, **kwargs):
+        ctx = super().get_context_data(**kwargs)
+        ctx["receipt"] = self.receipt
+        return ctx
+
+
+def receipt_status_api(request, pk):
+    receipt = get_object_or_404(Receipt, pk=pk)
+    resume_if_stalled(receipt)
+    return JsonResponse({
+        "ok": True,
+        "status": receipt.status,
+        "review_url": reverse("kakeibo:receipt_review", kwargs={"pk": receipt.pk}),
+    })
 
 
 class ReceiptReviewView(FormView):
     template_name = "kakeibo/receipt_review.html"
     form_class = ReceiptLineFormSet
 
+    def dispatch(self, request, *args, **kwargs):
+        self.receipt = get_object_or_404(Receipt, pk=kwargs["pk"])
+        if self.receipt.status == Receipt.STATUS_ERROR:
+            messages.error(request, "レシートの解析に失敗しました。もう一度アップロードしてください。")
+            return redirect("kakeibo:receipt_upload")
+        if self.receipt.status == Receipt.STATUS_REGISTERED:
+            messages.info(request, "このレシートは登録済みです。")
+            return self._redirect_to_expenses()
+        if self.receipt.status != Receipt.STATUS_DONE:
+            return redirect("kakeibo:receipt_processing", pk=self.receipt.pk)
+        return super().dispatch(request, *args, **kwargs)
+
     def get_form_kwargs(self):
         kwargs = super().get_form_kwargs()
-        kwargs["initial"] = self.request.session.get("ocr_initial", [])
+        kwargs["initial"] = [
+            {
+                "item": line.item,
+                "amount": line.amount,
+                "category": line.category_id,
+                "raw_text": line.raw_text,
+            }
+            for line in (self.receipt.lines.filter(include=True)
+                                           .only("receipt_id", "item", "amount", "category_id", "raw_text")
+                                           .order_by("y_min", "id"))
+        ]
         return kwargs
 
     def get_context_data(self, **kwargs):
         ctx = super().get_context_data(**kwargs)
-        ctx["image_url"] = self.request.session.get("ocr_image_url")
-        ctx["date"] = self.request.session.get("ocr_date")
+        ctx["image_url"] = self.receipt.image.url
+        ctx["date"] = self.receipt.date.isoformat()
         return ctx
 
     def form_valid(self, form):
         # 1) 登録日（戻り先の月）を確定
-        d_iso = self.request.session.get("ocr_date")
-        try:
-            d = date.fromisoformat(d_iso) if d_iso else date.today()
-        except Exception:
-            d = date.today()
+        d = self.receipt.date
 
-        # 2) 行ごとに登録
-        created = 0
+        # 2) 有効な行をまとめて登録（1行ずつ INSERT しない）
+        rows = []
         for f in form:
             if not getattr(f, "cleaned_data", None):
                 continue
@@ -643,52 +733,33 @@ class ReceiptReviewView(FormView):
             amount = f.cleaned_data.get("amount")
             if not item or amount is None:
                 continue
-            Expense.objects.create(
+            rows.append(Expense(
                 date=d,
                 item=item,
                 amount=amount,
                 category=f.cleaned_data.get("category") or None,
-            )
-            created += 1
-
-        # 3) セッションクリア & メッセージ
-        for k in ("ocr_initial", "ocr_image_url", "ocr_date"):
-            self.request.session.pop(k, None)
+            ))
+        with transaction.atomic():
+            # 登録済みにできた1回だけ INSERT する（戻る→再送信や連打で二重登録しない）
+            registered = (Receipt.objects.filter(pk=self.receipt.pk, status=Receipt.STATUS_DONE)
+                                         .update(status=Receipt.STATUS_REGISTERED))
+            if registered:
+                Expense.objects.bulk_create(rows, batch_size=500)
+        if not registered:
+            messages.info(self.request, "このレシートは登録済みです。")
+            return self._redirect_to_expenses()
+        clear_aggregate_cache()  # bulk_create は post_save を出さない
+        created = len(rows)
+
+        # 3) メッセージ
         messages.success(self.request, f"{created} 件登録しました。")
 
         # 4) その月の「全件表示」一覧へ戻る
+        return self._redirect_to_expenses()
+
+    def _redirect_to_expenses(self):
         try:
             base = reverse("kakeibo:expense_list")
-            return redirect(f"{base}?month={d.strftime('%Y-%m')}&view=all")
+            return redirect(f"{base}?month={self.receipt.date.strftime('%Y-%m')}&view=all")
         except NoReverseMatch:
             return redirect("/")
-
-# ===== forms.py =====
-from datetime import date
-from django import forms
-from django.forms import formset_factory
-from .models import Expense, Budget, Income, Category
-
-# ===== 予算フォーム =====
-class BudgetForm(forms.ModelForm):
-    month = forms.DateField(
-        label='対象月',
-        widget=forms.DateInput(attrs={'class': 'form-control', 'type': 'month'})
-    )
-
-
-    class Meta:
-        model = Budget
-        fields = ['month', 'category', 'amount']
-        widgets = {
-            'category': forms.Select(attrs={'class': 'form-select'}),
-            'amount':   forms.NumberInput(attrs={'class': 'form-control', 'min': 1, 'step': 1, 'inputmode': 'numeric'}),
-        }
-        labels = {'month':'対象月','category':'費目','amount':'予算金額'}
-        help_texts = {'amount':'1円以上の整数'}
-    def clean_amount(self):
-        v = self.cleaned_data['amount']
-        if v is None or v < 1:
-            raise forms.ValidationError('予算金額は1以上の整数を入力してください。')
-        return v
-# ===== レシートアップロードフォーム 
\ No newline at end of file